@@ -1,9 +1,14 @@
-from typing import NamedTuple, Dict, Set
+from typing import NamedTuple, Dict, List, Tuple
 import argparse
-import json
-import re
+import collections
 import urllib.request
 
+try:
+    # A much faster JSON parser.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 _AUTOTEL_MAP_PAGE_URL = "https://www.autotel.co.il/assets/map/maptest.php?lang=he"
 
 
@@ -11,16 +16,16 @@ class AutoTelCar(NamedTuple):
     id: int
     license_plate: str  # Parts of the license plate are separated by '-'.
     address: str
-
-    def __hash__(self):
-        return hash(self.license_plate)
+    plate_parts: Tuple[int, int, int]  # The numbers of the license plate, parsed once.
 
     @staticmethod
     def from_map_json(car_dict):
+        license_plate = car_dict["licencePlate"]
         return AutoTelCar(
             id=int(car_dict["nickname"]),
-            license_plate=car_dict["licencePlate"],
-            address=car_dict["addressHe"]
+            license_plate=license_plate,
+            address=car_dict["addressHe"],
+            plate_parts=tuple(int(num) for num in license_plate.split('-'))
         )
 
 
@@ -41,33 +46,40 @@ def _get_cars_map_data_variable(page_data: str) -> dict:
     :param page_data: The source of AutoTel's map page.
     """
 
-    json_match = re.search(r"(var cars = )(?P<data>\[.*\]);", page_data)
-    assert json_match is not None
-    json_data = json_match["data"]
-    return json.loads(json_data)
+    _VARIABLE_PREFIX = "var cars = "
+
+    # The variable is assigned in a single line, its value ends with the last '];' of that line.
+    data_start = page_data.find(_VARIABLE_PREFIX)
+    assert data_start != -1
+    data_start += len(_VARIABLE_PREFIX)
+    line_end = page_data.find("\n", data_start)
+    data_end = page_data.rfind("];", data_start, len(page_data) if line_end == -1 else line_end)
+    assert page_data.startswith("[", data_start) and data_end != -1
+    return json_loads(page_data[data_start:data_end + 1])
 
 
-def _create_license_plate_mapping(cars_map_data: dict) -> Dict[int, Set[AutoTelCar]]:
+def _create_license_plate_mapping(cars_map_data: dict) -> Dict[int, List[AutoTelCar]]:
     """
     Creates a mapping between a license plate portion number and AutoTel cars with that number.
     For example, a car with the license plate '12-345-67' will be included under the keys 12, 345 and 67.
+    Numbers without any cars aren't included in the mapping.
 
     :param cars_map_data: The (parsed) map data from AutoTel's map page.
     """
 
-    plate_map = {n: set() for n in range(1000)}
+    plate_map = collections.defaultdict(list)
     for entry in cars_map_data:
         items = entry["items"]
         if len(items) > 0:
             for car in (AutoTelCar.from_map_json(raw_car_data) for raw_car_data in items.values()):
-                license_plate_numbers = [int(num) for num in car.license_plate.split('-')]
-                for number in license_plate_numbers:
-                    plate_map[number].add(car)
+                # A number that appears twice in the same plate still lists the car once.
+                for number in set(car.plate_parts):
+                    plate_map[number].append(car)
 
     return plate_map
 
 
-def get_autotel_license_plate_mapping() -> Dict[int, Set[AutoTelCar]]:
+def get_autotel_license_plate_mapping() -> Dict[int, List[AutoTelCar]]:
     """
     Requests AutoTel's map page and returns a mapping between a license plate portion number and AutoTel cars with
     that number.
@@ -89,7 +101,7 @@ def get_summary_for_autotel_cars_with_number(num: int):
     if num < 0 or num > 999:
         raise IndexError(f"License plate number {num} is out of range")
 
-    cars = get_autotel_license_plate_mapping()[num]
+    cars = get_autotel_license_plate_mapping().get(num, [])
     car_count = len(cars)
     if car_count == 0:
         return "No cars were found."
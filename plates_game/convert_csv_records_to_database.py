@@ -1,62 +1,315 @@
 import sqlite3
 import argparse
-import csv
+import contextlib
+import itertools
+import mmap
+import multiprocessing
+import os
+import tempfile
 import time
 
+try:
+    # A thin binding of SQLite, with less overhead per statement than sqlite3. Used for the conversion only.
+    import apsw
+except ImportError:
+    apsw = None
 
-def register_csv_dialect():
+try:
+    # A SIMD accelerated CSV parser. Its raw API returns the fields as bytes, the regular one decodes every field of
+    # the file as UTF-8, which fails on this cp1252 encoded dataset.
+    from cisv._core import parse_file_raw as cisv_parse_file_raw
+except ImportError:
+    cisv_parse_file_raw = None
+
+_INSERT_BATCH_SIZE = 10000
+_INSERT_RECORD_STATEMENT = "INSERT INTO `records` VALUES (?, ?)"
+_INSERT_PLATE_PART_STATEMENT = "INSERT INTO `plate_parts` VALUES (?, ?)"
+_FIELD_DELIMITER = "|"
+_PLATE_NUMBER_COLUMN = "mispar_rechev"
+_PRODUCTION_YEAR_COLUMN = "shnat_yitzur"
+_DELIMITER = _FIELD_DELIMITER.encode()
+_STRIPPED_CHARACTERS = b'"\r\n'
+_FILE_ENCODING = 'cp1252'
+
+
+def connect_db(db_path):
+    """
+    Opens a database for the conversion, using apsw when it's installed and sqlite3 otherwise.
+    Either way the connection is in autocommit mode, so transactions have to be started and committed explicitly.
+    """
+    if apsw is not None:
+        return apsw.Connection(db_path)
+    return sqlite3.connect(db_path, isolation_level=None)
+
+
+def create_records_tables(db):
     """
-    Registers the custom dialect that's used in the CSV file.
-    :return: the name of the registered dialect.
+    Creates the tables that the CSV records are inserted into.
     """
-    _FIELD_DELIMITER = "|"
-    _DIALECT_NAME = "custom_dialect"
+    db.execute("CREATE TABLE `records` (`production_year` INTEGER , `plate_number` INTEGER);")
 
-    csv.register_dialect(_DIALECT_NAME, delimiter=_FIELD_DELIMITER, quoting=csv.QUOTE_ALL)
-    return _DIALECT_NAME
+    # Every distinct part of a plate gets its own row, so a number can be looked up with a single index scan.
+    # The parts aren't stored in `records` as well, since the rarity queries never read them from there.
+    db.execute("CREATE TABLE `plate_parts` (`part` INTEGER, `production_year` INTEGER);")
 
 
 def create_memory_db():
     """
     Creates a temporary in-memory database that will be used during the conversion.
     """
-    db = sqlite3.connect(":memory:")
-    db.execute("CREATE TABLE `records` (`production_year` INTEGER , `plate_number` INTEGER, `first` INTEGER, "
-               "`second` INTEGER, `third` INTEGER);")
+    db = connect_db(":memory:")
+    create_records_tables(db)
 
-    # Create indexes for super fast queries.
-    db.execute("CREATE INDEX `first_part_index` on `records`(`first`);")
-    db.execute("CREATE INDEX `second_part_index` on `records`(`second`);")
-    db.execute("CREATE INDEX `third_part_index` on `records`(`third`);")
+    # The appearance statistics of every number, so a rarity check is a single lookup.
+    db.execute("CREATE TABLE `number_counts` (`number` INTEGER PRIMARY KEY, `appearance_count` INTEGER, "
+               "`max_year` INTEGER);")
     return db
 
 
+def create_db_indexes(db):
+    """
+    Creates indexes for super fast queries.
+    Building them once all the records are inserted is much faster than updating them on every insert.
+    """
+    # Covers the rarity queries, so they never have to read the table itself.
+    db.execute("CREATE INDEX `plate_parts_index` on `plate_parts`(`part`, `production_year`);")
+
+
+def fill_number_counts(db):
+    """
+    Fills the `number_counts` table from the `plate_parts` table. Numbers that never appear get a count of 0.
+    """
+    db.execute("WITH RECURSIVE `numbers`(`number`) AS (SELECT 0 UNION ALL SELECT `number` + 1 FROM `numbers` "
+               "WHERE `number` < 999) "
+               "INSERT INTO `number_counts` SELECT `number`, COUNT(`part`), MAX(`production_year`) FROM `numbers` "
+               "LEFT JOIN `plate_parts` ON `part`=`number` GROUP BY `number`;")
+
+
 def split_plate_into_parts(plate_number):
     """
     Splits the plate number into parts.
     The length of each part depends on the length of the plate number itself.
+    Plate numbers don't start with 0's, so any number below 10,000,000 is a 7 digit plate number.
+    """
+    first, rest = divmod(plate_number, 100000)
+    if plate_number < 10_000_000:
+        second, third = divmod(rest, 100)
+    else:
+        second, third = divmod(rest, 1000)
+    return first, second, third
+
+
+def _iterate_cisv_records(csv_file_path):
+    """
+    Returns the plate number and production year fields of the CSV records, using cisv.
+    cisv parses the whole file at once, so only the two needed fields of each record are copied out of its result,
+    which is freed before the records are inserted. Only the header is decoded.
+    """
+    import numpy as np
+
+    # cisv refuses to parse an empty file, and it has no records anyway.
+    if os.path.getsize(csv_file_path) == 0:
+        return []
+
+    data, field_offsets, field_lengths, row_offsets = cisv_parse_file_raw(
+        csv_file_path, delimiter=_FIELD_DELIMITER, quote='"', skip_empty_lines=True)
+    data = data.tobytes()
+    header = [data[offset:offset + length].decode(_FILE_ENCODING, errors='replace')
+              for offset, length in zip(field_offsets[row_offsets[0]:row_offsets[1]].tolist(),
+                                        field_lengths[row_offsets[0]:row_offsets[1]].tolist())]
+    plate_number_index = header.index(_PLATE_NUMBER_COLUMN)
+    production_year_index = header.index(_PRODUCTION_YEAR_COLUMN)
+
+    record_offsets = row_offsets[1:-1]
+    if (np.diff(row_offsets[1:]) <= max(plate_number_index, production_year_index)).any():
+        raise IndexError("A CSV record is missing fields")
+
+    def get_column(column_index):
+        field_indexes = record_offsets + column_index
+        return [data[offset:offset + length]
+                for offset, length in zip(field_offsets[field_indexes].tolist(), field_lengths[field_indexes].tolist())]
+
+    return zip(get_column(plate_number_index), get_column(production_year_index))
+
+
+def _read_mmap_header(csv_records):
+    """
+    Reads the header of the memory mapped CSV file.
+
+    :return: the indexes of the plate number and production year fields.
+    """
+    header = [field.strip(_STRIPPED_CHARACTERS).decode(_FILE_ENCODING, errors='replace')
+              for field in csv_records.readline().split(_DELIMITER)]
+    return header.index(_PLATE_NUMBER_COLUMN), header.index(_PRODUCTION_YEAR_COLUMN)
+
+
+def _iterate_mmap_lines(csv_records, plate_number_index, production_year_index, end_offset):
+    """
+    Iterates over the plate number and production year fields of the memory mapped CSV records, from the current
+    position up to the last line that starts before the end offset.
+    The fields are split as bytes, since the fields we need are plain ASCII numbers there's no need to decode the
+    text. Assumes that the quoted fields never contain the delimiter.
+    """
+    while csv_records.tell() < end_offset:
+        line = csv_records.readline()
+        if line.isspace():
+            continue
+
+        fields = line.split(_DELIMITER)
+        yield fields[plate_number_index].strip(_STRIPPED_CHARACTERS), \
+            fields[production_year_index].strip(_STRIPPED_CHARACTERS)
+
+
+def _iterate_mmap_records(csv_file_path):
     """
-    if len(plate_number) == 7:
-        return int(plate_number[:2]), int(plate_number[2:-2]), int(plate_number[-2:])
-    elif len(plate_number) == 8:
-        return int(plate_number[:3]), int(plate_number[3:-3]), int(plate_number[-3:])
+    Iterates over the plate number and production year fields of the CSV records, using a memory mapped scan of
+    the file.
+    """
+    with open(csv_file_path, "rb") as csv_records_file:
+        # An empty file can't be memory mapped, and it has no records anyway.
+        if os.fstat(csv_records_file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(csv_records_file.fileno(), 0, access=mmap.ACCESS_READ) as csv_records:
+            plate_number_index, production_year_index = _read_mmap_header(csv_records)
+            yield from _iterate_mmap_lines(csv_records, plate_number_index, production_year_index, len(csv_records))
+
+
+def iterate_csv_records(csv_file_path):
+    """
+    Iterates over the records of the CSV file, yielding the plate number and production year field of each one.
+    Uses cisv when it's installed and falls back to a memory mapped scan of the file otherwise.
+    """
+    if cisv_parse_file_raw is not None:
+        return _iterate_cisv_records(csv_file_path)
+    return _iterate_mmap_records(csv_file_path)
 
 
-def insert_csv_line_into_db(record, db):
+def parse_csv_record(plate_number, production_year):
     """
-    Inserts a single CSV record into the DB. For now, we're interested only in the record's plate number.
+    Parses a single CSV record. For now, we're interested only in the record's plate number.
 
-    :param record: the parsed fields of the CSV record.
-    :param db: the DB to insert the record into.
+    :param plate_number: the plate number field of the CSV record.
+    :param production_year: the production year field of the CSV record.
+    :return: the production year and the plate number.
     """
-    plate_number = record["mispar_rechev"]
+    # Plate numbers don't start with 0's. Any number that starts with a 0 is actually a 7 digit plate number, which
+    # parsing the number takes care of.
+    return int(production_year), int(plate_number)
+
 
-    # Plate numbers don't start with 0's. Any number that starts with a 0 is actually a 7 digit plate number.
-    plate_number = plate_number.lstrip("0")
-    first, second, third = split_plate_into_parts(plate_number)
+def insert_records_batch(cursor, batch):
+    """
+    Inserts a batch of parsed records into the DB, along with their plate parts.
+
+    :param cursor: a cursor of the DB to insert the records into.
+    :param batch: the values returned by parse_csv_record for each record.
+    """
+    cursor.executemany(_INSERT_RECORD_STATEMENT, batch)
 
-    production_year = int(record["shnat_yitzur"])
-    db.execute("INSERT INTO `records` VALUES (?, ?, ?, ?, ?)", (production_year, plate_number, first, second, third))
+    # A number that appears twice on the same plate is still counted once for that plate.
+    cursor.executemany(_INSERT_PLATE_PART_STATEMENT,
+                       ((part, production_year)
+                        for production_year, plate_number in batch
+                        for part in set(split_plate_into_parts(plate_number))))
+
+
+def insert_records(db, records):
+    """
+    Parses and inserts the CSV records into the DB in batches.
+
+    :param db: the DB to insert the records into.
+    :param records: the plate number and production year fields of each record.
+    :return: the amount of inserted records.
+    """
+    # Reusing a single cursor saves creating one for every statement.
+    cursor = db.cursor()
+    record_count = 0
+    batch = []
+    for plate_number, production_year in records:
+        batch.append(parse_csv_record(plate_number, production_year))
+        if len(batch) >= _INSERT_BATCH_SIZE:
+            insert_records_batch(cursor, batch)
+            record_count += len(batch)
+            batch.clear()
+
+    insert_records_batch(cursor, batch)
+    return record_count + len(batch)
+
+
+def _convert_csv_shard(csv_file_path, start_offset, end_offset, shard_db_path):
+    """
+    Converts the records of the CSV file that start between the given offsets into their own database.
+    Runs in a worker process. Shards are only created for non-empty byte ranges, so the file is never empty here.
+
+    :return: the amount of converted records
+    """
+    with open(csv_file_path, "rb") as csv_records_file, \
+            mmap.mmap(csv_records_file.fileno(), 0, access=mmap.ACCESS_READ) as csv_records:
+        plate_number_index, production_year_index = _read_mmap_header(csv_records)
+
+        # Skip to the first line that starts in the shard, the previous shard takes care of the partial line.
+        if start_offset > csv_records.tell():
+            csv_records.seek(start_offset - 1)
+            csv_records.readline()
+
+        with contextlib.closing(connect_db(shard_db_path)) as shard_db:
+            # The shard is a temporary file, there's nothing to protect.
+            shard_db.execute("PRAGMA journal_mode=OFF;")
+            shard_db.execute("PRAGMA synchronous=OFF;")
+            create_records_tables(shard_db)
+            shard_db.execute("BEGIN")
+            record_count = insert_records(
+                shard_db, _iterate_mmap_lines(csv_records, plate_number_index, production_year_index, end_offset))
+            shard_db.execute("COMMIT")
+
+    return record_count
+
+
+def _convert_csv_file_in_parallel(csv_file_path, jobs):
+    """
+    Converts the CSV file into a memory DB using several processes.
+    The file is split into byte ranges, each one is converted into its own shard database, and the shards are then
+    merged into the memory DB in order. The memory DB is created only once the workers are done, so no SQLite
+    connection is open while the pool forks.
+
+    :return: the memory DB and the amount of converted records
+    """
+    with open(csv_file_path, "rb") as csv_records_file:
+        csv_records_file.readline()
+        data_offset = csv_records_file.tell()
+        file_size = os.fstat(csv_records_file.fileno()).st_size
+
+    # Small files get fewer shards, and a file without records isn't sharded at all.
+    data_size = file_size - data_offset
+    jobs = min(jobs, data_size)
+    if jobs == 0:
+        return create_memory_db(), 0
+
+    shard_size = data_size // jobs + 1
+    with tempfile.TemporaryDirectory() as shards_dir_path:
+        shards = [(csv_file_path, data_offset + shard_size * i, min(data_offset + shard_size * (i + 1), file_size),
+                   os.path.join(shards_dir_path, f"shard_{i}.db"))
+                  for i in range(jobs)]
+        # Rounding the shard size up may leave the last shards empty.
+        shards = [shard for shard in shards if shard[1] < shard[2]]
+        with multiprocessing.Pool(len(shards)) as pool:
+            record_counts = pool.starmap(_convert_csv_shard, shards)
+
+        db = create_memory_db()
+        try:
+            for _, _, _, shard_db_path in shards:
+                db.execute("ATTACH DATABASE ? AS `shard`", (shard_db_path,))
+                db.execute("BEGIN")
+                db.execute("INSERT INTO `records` SELECT * FROM `shard`.`records`;")
+                db.execute("INSERT INTO `plate_parts` SELECT * FROM `shard`.`plate_parts`;")
+                db.execute("COMMIT")
+                db.execute("DETACH DATABASE `shard`")
+        except BaseException:
+            db.close()
+            raise
+
+    return db, sum(record_counts)
 
 
 def write_output_db_file(src_db, output_db_path):
@@ -66,29 +319,39 @@ def write_output_db_file(src_db, output_db_path):
     :param src_db: the database to copy
     :param output_db_path: where to store the output database on the hard-drive.
     """
-    with sqlite3.connect(output_db_path) as output_db:
-        src_db.backup(output_db)
+    with contextlib.closing(connect_db(output_db_path)) as output_db:
+        # Copy all the pages in a single step.
+        if apsw is not None:
+            with output_db.backup("main", src_db, "main") as backup:
+                backup.step(-1)
+        else:
+            src_db.backup(output_db, pages=-1)
 
 
-def convert_csv_file_to_db(csv_file_path, output_db_path):
+def convert_csv_file_to_db(csv_file_path, output_db_path, jobs=1):
     """
     Converts a csv file of car records to an sqlite3 database.
 
+    :param jobs: the amount of processes to parse the file with. More than one process always uses the memory mapped
+                 reader, cisv is used only when converting with a single process.
     :return: the amount of converted records
     """
-    _FILE_ENCODING = 'cp1252'
-
-    csv_dialect_name = register_csv_dialect()
-
-    with create_memory_db() as db:
-        with open(csv_file_path, encoding=_FILE_ENCODING, errors='replace') as csv_records_file:
-            records_reader = csv.DictReader(csv_records_file, dialect=csv_dialect_name)
-            for record in records_reader:
-                insert_csv_line_into_db(record, db)
+    if jobs > 1:
+        db, record_count = _convert_csv_file_in_parallel(csv_file_path, jobs)
+    else:
+        db = create_memory_db()
 
-            record_count = records_reader.line_num
+    with contextlib.closing(db):
+        if jobs <= 1:
+            # A single explicit transaction with batched inserts is much faster than inserting row by row.
+            db.execute("BEGIN")
+            record_count = insert_records(db, iterate_csv_records(csv_file_path))
+            db.execute("COMMIT")
 
-        db.commit()
+        db.execute("BEGIN")
+        create_db_indexes(db)
+        fill_number_counts(db)
+        db.execute("COMMIT")
         write_output_db_file(db, output_db_path)
 
     return record_count
@@ -98,9 +361,12 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("csv_file_path")
     parser.add_argument("output_db_path")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="the amount of processes to use, defaults to 1. cisv is used to parse the file only with "
+                             "a single process")
     args = parser.parse_args()
     start_time = int(time.time())
-    record_count = convert_csv_file_to_db(args.csv_file_path, args.output_db_path)
+    record_count = convert_csv_file_to_db(args.csv_file_path, args.output_db_path, args.jobs)
     end_time = int(time.time())
     print(f"Parsed {record_count:,} records in {end_time-start_time} seconds.")
 
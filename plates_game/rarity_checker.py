@@ -1,11 +1,14 @@
 import sqlite3
 import argparse
+import bisect
+import functools
 import math
+import os
 
 
 def get_total_record_count(records_db_path):
     with sqlite3.connect(records_db_path) as db:
-        (total_count,) = db.execute("SELECT COUNT (`plate_number`) FROM `records`;").fetchone()
+        (total_count,) = db.execute("SELECT COUNT(*) FROM `records`;").fetchone()
     return total_count
 
 
@@ -14,22 +17,42 @@ def get_latest_production_year_and_appearance_count(db, number):
     Returns the latest production year of a car with the specified number in its plate and the number's
      appearance count.
     """
-    return db.execute("SELECT MAX(`production_year`), COUNT(*) from `records` WHERE `first`=:1 OR "
-                      "second=:1 OR `third`=:1;", (number,)).fetchone()
+    return db.execute("SELECT `max_year`, `appearance_count` from `number_counts` WHERE `number`=:1;",
+                      (number,)).fetchone()
+
+
+def get_total_count_and_number_statistics(db, number):
+    """
+    Returns the total record count, the latest production year of a car with the specified number in its plate and
+     the number's appearance count, all in a single query.
+    """
+    return db.execute("SELECT (SELECT COUNT(*) FROM `records`), `max_year`, `appearance_count` from `number_counts` "
+                      "WHERE `number`=:1;", (number,)).fetchone()
+
+
+def _validate_number(number_to_check):
+    if number_to_check < 0 or number_to_check > 999:
+        raise ValueError("Number should be between 0 and 999")
 
 
 def _get_sorted_counts(db):
     """
-    Returns a sorted list of the appearance counts of each number in the Israeli plates.
+    Returns an ascending sorted list of the appearance counts of each number in the Israeli plates.
+    """
+    return [appearance_count for (appearance_count,) in
+            db.execute("SELECT `appearance_count` from `number_counts` ORDER BY `appearance_count`;")]
+
+
+@functools.lru_cache(maxsize=4)
+def _get_sorted_counts_cached(records_db_path, modification_time):
     """
-    numbers = []
-    for i in range(1000):
-        appearance_count = db.execute("SELECT COUNT(*) from `records` WHERE `first`=:1 OR `second`=:1 OR `third`=:1",
-                                      (i, )).fetchone()[0]
-        numbers.append(appearance_count)
+    Returns the sorted appearance counts of the DB, computing them only once per version of the DB file.
 
-    numbers.sort(reverse=True)
-    return numbers
+    :param records_db_path: a path to a DB containing records of israeli plates
+    :param modification_time: the modification time of the DB file, so a rewritten DB isn't served from the cache.
+    """
+    with sqlite3.connect(records_db_path) as db:
+        return tuple(_get_sorted_counts(db))
 
 
 def estimate_difficulty_level(records_db_path, number_to_check):
@@ -39,13 +62,15 @@ def estimate_difficulty_level(records_db_path, number_to_check):
     :param records_db_path: a path to a DB containing records of israeli plates
     :param number_to_check: the number of which to estimate the difficulty
     """
-    if number_to_check < 0 or number_to_check > 999:
-        raise ValueError("Number should be between 0 and 999")
+    _validate_number(number_to_check)
 
+    sorted_appearance_count = _get_sorted_counts_cached(records_db_path, os.path.getmtime(records_db_path))
     with sqlite3.connect(records_db_path) as db:
-        sorted_appearance_count = _get_sorted_counts(db)
         _, appearance_count = get_latest_production_year_and_appearance_count(db, number_to_check)
-        return math.floor((sorted_appearance_count.index(appearance_count)) / len(sorted_appearance_count) * 100) + 1
+
+    # The amount of numbers that appear more often than the checked number.
+    rank = len(sorted_appearance_count) - bisect.bisect_right(sorted_appearance_count, appearance_count)
+    return math.floor(rank / len(sorted_appearance_count) * 100) + 1
 
 
 def check_number_rarity(records_db_path, number_to_check):
@@ -55,8 +80,7 @@ def check_number_rarity(records_db_path, number_to_check):
     :param records_db_path: a path to a DB containing records of israeli plates.
     :param number_to_check: the number to check.
     """
-    if number_to_check < 0 or number_to_check > 999:
-        raise ValueError("Number should be between 0 and 999")
+    _validate_number(number_to_check)
 
     with sqlite3.connect(records_db_path) as db:
         latest_production_year, appearance_count = get_latest_production_year_and_appearance_count(db, number_to_check)
@@ -65,8 +89,12 @@ def check_number_rarity(records_db_path, number_to_check):
 
 
 def main(args):
-    total_count = get_total_record_count(args.records_db_path)
-    appearance_count, latest_production_year = check_number_rarity(args.records_db_path, int(args.number_to_check))
+    number_to_check = int(args.number_to_check)
+    _validate_number(number_to_check)
+    with sqlite3.connect(args.records_db_path) as db:
+        total_count, latest_production_year, appearance_count = get_total_count_and_number_statistics(
+            db, number_to_check)
+
     print(f"The number {args.number_to_check} appears on {appearance_count:,}"
           f" plates out of a total of {total_count:,}.")
 